@@ -11,6 +11,7 @@
 Unit tests for the module clustering.py.
 """
 import os
+import shutil
 import pytest
 import numpy as np
 from unittest.mock import patch, call, MagicMock
@@ -57,7 +58,7 @@ def test_cluster_traj(mock_gmx, mock_fn_1, mock_fn_2, mock_fn_3, capfd):
 
     # Test 4: No index file is provided
     mock_gmx.reset_mock()
-    args = ['gmx', 'make_ndx', '-f', 'ensemble_md/tests/data/sys.gro', '-o', 'index.ndx']
+    args = ['gmx', '-quiet', 'make_ndx', '-f', 'ensemble_md/tests/data/sys.gro', '-o', 'index.ndx']
     with pytest.raises(FileNotFoundError, match="No such file or directory: 'index.ndx'"):
         # We do not really run GROMACS commands so no index.ndx will be generated.
         # Still, we reach our goal to test the conditional block when inputs['index'] is None.
@@ -70,6 +71,11 @@ def test_cluster_traj(mock_gmx, mock_fn_1, mock_fn_2, mock_fn_3, capfd):
     grps['center'] = 'test'
     with pytest.raises(ValueError, match='The group "test" is not present in the provided/generated index file.'):
         clustering.cluster_traj('gmx', inputs, grps, coupled_only=True, cutoff=0.13, suffix='test')
+
+    # A group name that only appears as part of another group name should not be considered present
+    grps['center'] = 'HOS_MO'
+    with pytest.raises(ValueError, match='The group "HOS_MO" is not present in the provided/generated index file.'):
+        clustering.cluster_traj('gmx', inputs, grps, coupled_only=True, cutoff=0.13, suffix='test')
     grps['center'] = 'HOS_MOL'
 
     # Test 6: An index file is provided but no coupled configurations are found
@@ -89,11 +95,14 @@ def test_cluster_traj(mock_gmx, mock_fn_1, mock_fn_2, mock_fn_3, capfd):
     with open('rmsd_test.xvg', 'w') as f:
         f.write('0 1\n1 1\n2 1\n3 1\n4 1\n5 1\n')
 
+    # save a dummy nojump_test.xtc to check that the intermediate trajectory is removed
+    open('nojump_test.xtc', 'w').close()
+
     inputs['xvg'] = 'ensemble_md/tests/data/traj.xvg'
     clustering.cluster_traj('gmx', inputs, grps, coupled_only=True, cutoff=0.13, suffix='test')
 
     args_1 = [
-        'gmx', 'trjconv',
+        'gmx', '-quiet', 'trjconv',
         '-f', 'ensemble_md/tests/data/traj.xtc',
         '-s', 'ensemble_md/tests/data/sys.gro',
         '-n', 'ensemble_md/tests/data/sys.ndx',
@@ -104,7 +113,7 @@ def test_cluster_traj(mock_gmx, mock_fn_1, mock_fn_2, mock_fn_3, capfd):
         '-dropover', '0'
     ]
     args_2 = [
-        'gmx', 'trjconv',
+        'gmx', '-quiet', 'trjconv',
         '-f', 'nojump_test.xtc',
         '-s', 'ensemble_md/tests/data/sys.gro',
         '-n', 'ensemble_md/tests/data/sys.ndx',
@@ -114,7 +123,7 @@ def test_cluster_traj(mock_gmx, mock_fn_1, mock_fn_2, mock_fn_3, capfd):
         '-ur', 'compact',
     ]
     args_3 = [
-        'gmx', 'cluster',
+        'gmx', '-quiet', 'cluster',
         '-f', 'center_test.xtc',
         '-s', 'ensemble_md/tests/data/sys.gro',
         '-n', 'ensemble_md/tests/data/sys.ndx',
@@ -126,7 +135,7 @@ def test_cluster_traj(mock_gmx, mock_fn_1, mock_fn_2, mock_fn_3, capfd):
         '-method', 'linkage',
     ]
     args_4 = [
-        'gmx', 'rms',
+        'gmx', '-quiet', 'rms',
         '-f', 'clusters_test.pdb',
         '-s', 'clusters_test.pdb',
         '-o', 'rmsd_test.xvg',
@@ -148,34 +157,214 @@ def test_cluster_traj(mock_gmx, mock_fn_1, mock_fn_2, mock_fn_3, capfd):
     assert 'Range of RMSD values: from 1.861 to 6.340 nm' in out
     assert 'Average RMSD: 4.379 nm' in out
     assert 'Number of clusters: 2' in out
+    assert 'Number of transitions between the two clusters: 5' in out
     assert '  - Cluster 1 accounts for 60.00% of the total configurations.' in out
     assert '  - Cluster 2 accounts for 40.00% of the total configurations.' in out
     assert 'Inter-medoid RMSD between the two biggest clusters: 1.000 nm' in out
+    assert os.path.exists('nojump_test.xtc') is False
+
+    # Test 8: The inter-medoid RMSD computed after the medoids were written is reused
+    mock_gmx.reset_mock()
+    open('clusters_test.pdb', 'w').close()
+    os.utime('clusters_test.pdb', (0, 0))
+    clustering.cluster_traj('gmx', inputs, grps, coupled_only=True, cutoff=0.13, suffix='test')
+    assert mock_gmx.call_count == 3
+    out, err = capfd.readouterr()
+    assert 'Reusing the inter-medoid RMSD from a previous run ...' in out
+    assert 'Inter-medoid RMSD between the two biggest clusters: 1.000 nm' in out
 
+    mock_gmx.reset_mock()
+    clustering.cluster_traj('gmx', inputs, grps, coupled_only=True, cutoff=0.13, suffix='test', cache=False)
+    assert mock_gmx.call_count == 4
+
+    # Test 9: The medoids have the same timestamp as the inter-medoid RMSD, so it is unclear which is newer
+    mock_gmx.reset_mock()
+    os.utime('clusters_test.pdb', ns=(os.stat('rmsd_test.xvg').st_mtime_ns, os.stat('rmsd_test.xvg').st_mtime_ns))
+    clustering.cluster_traj('gmx', inputs, grps, coupled_only=True, cutoff=0.13, suffix='test')
+    assert mock_gmx.call_count == 4
+    out, err = capfd.readouterr()
+    assert 'Reusing the inter-medoid RMSD from a previous run ...' not in out
+
+    os.remove('clusters_test.pdb')
     os.remove('rmsd_test.xvg')
     os.remove('traj_0.xvg')
 
 
+@patch('ensemble_md.analysis.clustering.get_cluster_info')
+@patch('ensemble_md.analysis.clustering.run_gmx_cmd')
+def test_cluster_traj_cache(mock_gmx, mock_fn, capfd):
+    mock_gmx.return_value = 0, MagicMock(), MagicMock()  # returncode, stdout, stderr
+    mock_fn.return_value = ([1.861, 6.340], 4.379, 1)  # rmsd_range, avg_rmsd, n_clusters
+    inputs = {
+        'traj': 'ensemble_md/tests/data/traj.xtc',
+        'config': 'ensemble_md/tests/data/sys.gro',
+        'xvg': 'ensemble_md/tests/data/traj.xvg',
+        'index': 'ensemble_md/tests/data/sys.ndx',
+    }
+    grps = {
+        'center': 'HOS_MOL',
+        'rmsd': 'complex_heavy',
+        'output': 'HOS_MOL'
+    }
+    cluster_outputs = ['rmsd_clust_cache.xpm', 'rmsd_dist_cache.xvg', 'cluster_cache.log', 'clusters_cache.pdb']
+
+    # Test 1: The outputs of gmx cluster are not generated (as GROMACS commands are mocked), so nothing is cached
+    clustering.cluster_traj('gmx', inputs, grps, cutoff=0.13, suffix='cache')
+    assert mock_gmx.call_count == 3
+    assert os.path.exists('.cluster_cache') is False
+
+    # Test 2: The outputs are present after the first run, so the second run reuses them
+    for f in cluster_outputs:
+        open(f, 'w').close()
+    mock_gmx.reset_mock()
+    clustering.cluster_traj('gmx', inputs, grps, cutoff=0.13, suffix='cache')
+    assert mock_gmx.call_count == 3
+    assert len(os.listdir('.cluster_cache')) == 1
+
+    mock_gmx.reset_mock()
+    clustering.cluster_traj('gmx', inputs, grps, cutoff=0.13, suffix='cache')
+    out, err = capfd.readouterr()
+    assert mock_gmx.call_count == 0
+    assert 'Reusing the outputs of gmx cluster from a previous run with the same inputs and options ...' in out
+
+    # Test 3: Different options or disabled caching
+    clustering.cluster_traj('gmx', inputs, grps, cutoff=0.1, suffix='cache')
+    assert mock_gmx.call_count == 3
+
+    mock_gmx.reset_mock()
+    clustering.cluster_traj('gmx', inputs, grps, cutoff=0.13, suffix='cache', cache=False)
+    assert mock_gmx.call_count == 3
+
+    # Test 4: The outputs have been modified (here, by the run with cutoff=0.1) since they were cached
+    with open('cluster_cache.log', 'w') as f:
+        f.write('modified')
+    mock_gmx.reset_mock()
+    clustering.cluster_traj('gmx', inputs, grps, cutoff=0.13, suffix='cache')
+    assert mock_gmx.call_count == 3
+
+    # Test 5: The index file regenerated by gmx make_ndx in every run does not prevent reusing the outputs
+    def touch_index(args, prompt_input=None):
+        if 'make_ndx' in args:
+            shutil.copy('ensemble_md/tests/data/sys.ndx', 'index.ndx')  # a new file (and mtime) in every run
+        return 0, MagicMock(), MagicMock()
+
+    mock_gmx.side_effect = touch_index
+    mock_gmx.reset_mock()
+    inputs['index'] = None
+    clustering.cluster_traj('gmx', inputs, grps, cutoff=0.13, suffix='cache')
+    assert mock_gmx.call_count == 4  # make_ndx, trjconv, trjconv, cluster
+
+    mock_gmx.reset_mock()
+    inputs['index'] = None
+    clustering.cluster_traj('gmx', inputs, grps, cutoff=0.13, suffix='cache')
+    assert mock_gmx.call_count == 1  # make_ndx only
+
+    for f in cluster_outputs + ['index.ndx']:
+        os.remove(f)
+    shutil.rmtree('.cluster_cache')
+
+
+def test_has_coupled_state():
+    assert clustering._has_coupled_state('ensemble_md/tests/data/traj.xvg') is True
+
+    analyze_traj.convert_npy2xvg([np.ones(26), np.array([1, 2, 0, 10, 20])], 2)
+    assert clustering._has_coupled_state('traj_0.xvg') is False
+    assert clustering._has_coupled_state('traj_1.xvg') is True
+
+    os.remove('traj_0.xvg')
+    os.remove('traj_1.xvg')
+
+
+def write_3_cluster_log(cluster_log):
+    # Writes a LOG file different from ensemble_md/tests/data/cluster.log, with a third cluster, and an old timestamp
+    with open('ensemble_md/tests/data/cluster.log', 'r') as f:
+        content = f.read().replace('Found 2 clusters', 'Found 3 clusters')
+    content += '  3 |   2  0.010 |  12500 .005 |  12500  12502\n'
+    with open(cluster_log, 'w') as f:
+        f.write(content)
+    os.utime(cluster_log, (1e9, 1e9))
+
+
 def test_get_cluster_info():
-    cluster_log = 'ensemble_md/tests/data/cluster.log'
-    results = clustering.get_cluster_info(cluster_log)
+    # We work on a copy of the LOG file so that the JSON file saved next to it does not end up in the data folder
+    cluster_log = 'cluster_test.log'
+    shutil.copy('ensemble_md/tests/data/cluster.log', cluster_log)
+    os.utime(cluster_log, (0, 0))
 
+    # Test 1: Parse the LOG file
+    results = clustering.get_cluster_info(cluster_log)
     assert results[0] == [0.0236461, 0.316756]
     assert results[1] == 0.182848
     assert results[2] == 2
+    assert os.path.exists('cluster_test_info.json')
+
+    # Test 2: The saved results are reused
+    with patch('ensemble_md.analysis.clustering.mmap') as mock_mmap:
+        assert clustering.get_cluster_info(cluster_log) == results
+        mock_mmap.mmap.assert_not_called()
+
+    # Test 3: The LOG file is parsed again once it is modified
+    os.utime(cluster_log)
+    with patch('ensemble_md.analysis.clustering.mmap', wraps=clustering.mmap) as mock_mmap:
+        assert clustering.get_cluster_info(cluster_log) == results
+        mock_mmap.mmap.assert_called_once()
+
+    # Test 4: A different LOG file with an older timestamp replaces the LOG file (e.g., via cp -p or rsync -a)
+    write_3_cluster_log(cluster_log)
+    assert clustering.get_cluster_info(cluster_log)[2] == 3
+
+    os.remove(cluster_log)
+    os.remove('cluster_test_info.json')
 
 
 def test_get_cluster_members():
-    cluster_log = 'ensemble_md/tests/data/cluster.log'
-    clusters, sizes = clustering.get_cluster_members(cluster_log)
-    assert clusters == {
+    # We work on a copy of the LOG file so that the NPZ file saved next to it does not end up in the data folder
+    cluster_log = 'cluster_test.log'
+    shutil.copy('ensemble_md/tests/data/cluster.log', cluster_log)
+    os.utime(cluster_log, (0, 0))
+    expected = {
         1: [0, 178, 184, 186, 300, 302, 304, 306, 308, 310, 312, 318, 362, 366, 370, 372, 374, 376, 378, 380, 382, 390, 460, 464, 468, 470, 476],  # noqa: E501
         2: [11910, 11992, 11996, 12014, 12054, 12058, 12062, 12064, 12084, 12092, 12098, 12100, 12102, 12104, 12106, 12108, 12110, 12112, 12114, 12116, 12118, 12120, 12242, 12262, 12310, 12318, 12330, 12334, 12340],  # noqa: E501
     }
+
+    # Test 1: Parse the LOG file
+    clusters, sizes = clustering.get_cluster_members(cluster_log)
+    assert list(clusters.keys()) == [1, 2]
+    for i in clusters:
+        assert isinstance(clusters[i], np.ndarray)
+        assert clusters[i].tolist() == expected[i]
     assert sizes == {1: 27/56, 2: 29/56}
+    assert os.path.exists('cluster_test_members.npz')
+
+    # Test 2: The saved members are reused
+    with patch('ensemble_md.analysis.clustering._parse_cluster_log') as mock_parse:
+        clusters, sizes = clustering.get_cluster_members(cluster_log)
+        mock_parse.assert_not_called()
+    assert list(clusters.keys()) == [1, 2]
+    for i in clusters:
+        assert clusters[i].tolist() == expected[i]
+    assert sizes == {1: 27/56, 2: 29/56}
+
+    # Test 3: The LOG file is parsed again once it is modified
+    os.utime(cluster_log)
+    with patch('ensemble_md.analysis.clustering._parse_cluster_log', wraps=clustering._parse_cluster_log) as mock_parse:  # noqa: E501
+        clusters, sizes = clustering.get_cluster_members(cluster_log)
+        mock_parse.assert_called_once_with(cluster_log)
+    for i in clusters:
+        assert clusters[i].tolist() == expected[i]
+
+    # Test 4: A different LOG file with an older timestamp replaces the LOG file (e.g., via cp -p or rsync -a)
+    write_3_cluster_log(cluster_log)
+    clusters, sizes = clustering.get_cluster_members(cluster_log)
+    assert list(clusters.keys()) == [1, 2, 3]
+    assert clusters[3].tolist() == [12500, 12502]
+    assert sizes == {1: 27/58, 2: 29/58, 3: 2/58}
+
+    os.remove(cluster_log)
+    os.remove('cluster_test_members.npz')
 
 
-@patch('ensemble_md.analysis.clustering.plt')
+@patch('matplotlib.pyplot')
 def test_analyze_transitions(mock_plt):
     # Test 1: No transitions
     clusters = {
@@ -223,7 +412,7 @@ def test_analyze_transitions(mock_plt):
     mock_plt.savefig.assert_called_once_with('cluster_distribution.png', dpi=600)
 
     assert list(mock_plt.bar.call_args_list[0][0][0]) == [1, 2, 3]
-    assert mock_plt.bar.call_args_list[0][0][1] == [17, 19, 13]
+    assert list(mock_plt.bar.call_args_list[0][0][1]) == [17, 19, 13]
     assert mock_plt.bar.call_args_list[0][1] == {'width': 0.35}
 
     # 3-2. plt_type = 'xy', short traj
@@ -255,6 +444,15 @@ def test_analyze_transitions(mock_plt):
     mock_plt.xlabel.assert_called_once_with('Time frame (ns)')
     assert (mock_plt.plot.call_args_list[0][0][0] == np.arange(2000) / 1000).all()
 
-    # 3-4. invalid plt_type
+    # 3-4. plt_type = 'xy', very long traj that is downsampled for plotting
+    mock_plt.reset_mock()
+    t = np.arange(250000)
+    clusters = {1: t[t % 3 == 0], 2: t[t % 3 != 0]}
+
+    results = clustering.analyze_transitions(clusters, plot_type='xy')
+    assert (mock_plt.plot.call_args_list[0][0][0] == np.arange(0, 250000, 2) / 1000).all()
+    assert (mock_plt.plot.call_args_list[0][0][1] == results[1][::2]).all()
+
+    # 3-5. invalid plt_type
     with pytest.raises(ValueError, match='Invalid plot type: test. The plot type must be either "bar" or "xy" or unspecified.'):  # noqa: E501
         clustering.analyze_transitions(clusters, plot_type='test')